@@ -0,0 +1,553 @@
+from concurrent.futures import ProcessPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import contextlib
+import functools
+import itertools
+import threading
+import argparse
+import tracemalloc
+import tempfile
+import json
+import time
+import random
+import glob
+import gc
+import io
+import os
+
+import crawler
+
+sampleQueries = [
+    "going to mess",
+    "love",
+    "the world as we know it",
+    "a day without sunshine is like you know night",
+    "it is our choices harry that show what we truly are",
+]
+
+
+def measureMemory(load):
+    # Bytes still allocated by whatever load() returns, once it has returned
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def timeQueries(invertedIndex, queries, repeat=5):
+    # Mean seconds per findWords() call, output discarded
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for query in queries:
+                crawler.findWords(query, invertedIndex)
+        return (time.perf_counter() - start) / (repeat * len(queries))
+
+
+def benchIndexLayout(path):
+    # Compare the plain dict-of-dicts layout with InvertedIndex
+    with open(path, 'r') as f:
+        text = f.read()
+
+    dictIndex, dictBytes = measureMemory(lambda: json.loads(text))
+    packedIndex, packedBytes = measureMemory(
+        lambda: crawler.InvertedIndex.fromDict(json.loads(text)))
+
+    print(f"Index layout ({path}, {len(packedIndex)} terms, {len(packedIndex.docUrls)} pages)")
+    print(f"\tdict of dicts:  {dictBytes / 1e6:8.2f} MB")
+    print(f"\tInvertedIndex:  {packedBytes / 1e6:8.2f} MB, "
+          f"{timeQueries(packedIndex, sampleQueries) * 1e3:8.2f} ms/query")
+    return dictIndex, packedIndex
+
+
+def sampleLongQueries(invertedIndex, count=40, seed=1):
+    # Runs of 5-10 consecutive words taken from indexed pages; every other
+    # query has one word replaced so it only has subphrase matches
+    rng = random.Random(seed)
+    pageWords = {}
+    for word, postings in invertedIndex.items():
+        for page, positions in postings.items():
+            for pos in positions:
+                pageWords.setdefault(page, {})[pos] = word
+
+    queries = []
+    pages = sorted(pageWords)
+    vocabulary = sorted(invertedIndex)
+    for i in range(count):
+        words = pageWords[rng.choice(pages)]
+        length = rng.randint(5, 10)
+        start = rng.randrange(max(1, len(words) - length))
+        query = [words.get(start + k, 'the') for k in range(length)]
+        if i % 2:
+            query[rng.randrange(length)] = rng.choice(vocabulary)
+        queries.append(' '.join(query))
+    return queries
+
+
+def setPhraseMatch(phrase, invertedIndex, candidatePages):
+    # phraseMatch() as it was before positional intersection, for comparison
+    words = phrase.lower().split()
+    exactPages = []
+    for page in candidatePages:
+        wordPositions = [set(invertedIndex.get(word, {}).get(page, [])) for word in words]
+        for start in wordPositions[0]:
+            if all((start + offset) in wordPositions[offset] for offset in range(1, len(words))):
+                exactPages.append(page)
+                break
+    return exactPages
+
+
+def phraseCandidates(query, invertedIndex):
+    # Full and partial candidate pages, chosen the way findWords() does
+    words = query.lower().split()
+    matchCounts = {}
+    for word in words:
+        for page in invertedIndex.get(word, {}):
+            matchCounts[page] = matchCounts.get(page, 0) + 1
+    full = {page for page, count in matchCounts.items() if count == len(words)}
+    weak = {page for page, count in matchCounts.items() if 1 < count < len(words)}
+    return words, full, weak
+
+
+def setPhraseStage(query, dictIndex):
+    words, full, weak = phraseCandidates(query, dictIndex)
+    matches = {query: set(setPhraseMatch(query, dictIndex, full))}
+    for subphrase in crawler.computeSubPhrases(query):
+        matches[subphrase] = set(setPhraseMatch(subphrase, dictIndex, weak))
+    return matches
+
+
+def matcherPhraseStage(query, invertedIndex):
+    words, full, weak = phraseCandidates(query, invertedIndex)
+    matcher = crawler.PhraseMatcher(invertedIndex, words)
+    matches = {query: set(matcher.pages(0, len(words), full))}
+    for length in range(2, len(words)):
+        for start in range(len(words) - length + 1):
+            matches[' '.join(words[start:start + length])] = set(
+                matcher.pages(start, length, weak))
+    return matches
+
+
+def benchPhraseMatch(dictIndex, packedIndex):
+    # Phrase stage of findWords() for 5-10 word queries: per-page position
+    # sets (the previous phraseMatch) against PhraseMatcher
+    queries = sampleLongQueries(packedIndex)
+    for query in queries:
+        assert setPhraseStage(query, dictIndex) == matcherPhraseStage(query, packedIndex), query
+
+    timings = []
+    for stage, invertedIndex in ((setPhraseStage, dictIndex), (matcherPhraseStage, packedIndex)):
+        start = time.perf_counter()
+        for query in queries:
+            stage(query, invertedIndex)
+        timings.append((time.perf_counter() - start) / len(queries))
+
+    print(f"Phrase matching ({len(queries)} queries of 5-10 words)")
+    print(f"\tposition sets:  {timings[0] * 1e3:8.2f} ms/query")
+    print(f"\tPhraseMatcher:  {timings[1] * 1e3:8.2f} ms/query "
+          f"({timings[0] / timings[1]:.1f}x)")
+
+
+def benchSearch(invertedIndex, k=10, repeat=5):
+    # Ranked top k search against the grouped listing of findWords()
+    queries = sampleQueries + sampleLongQueries(invertedIndex, count=20)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            crawler.searchIndex(query, invertedIndex, k)
+    searchTime = (time.perf_counter() - start) / (repeat * len(queries))
+
+    print(f"Search ({len(queries)} queries)")
+    print(f"\tfindWords:      {timeQueries(invertedIndex, queries, repeat) * 1e3:8.2f} ms/query")
+    print(f"\tsearchIndex:    {searchTime * 1e3:8.2f} ms/query (top {k})")
+
+
+def makeWord(rng):
+    return ''.join(rng.choice('bcdfghjklmnprstvwz') + rng.choice('aeiou')
+                   for _ in range(rng.randint(1, 4)))
+
+
+def writeFixtureSite(directory, numPages=60, seed=1):
+    # Write a site laid out like quotes.toscrape.com: numbered quote pages,
+    # author pages and tag pages, each linking to others. Paths ending in
+    # '/' are saved as index.html so http.server can serve the directory.
+    rng = random.Random(seed)
+    vocabulary = [makeWord(rng) for _ in range(2000)]
+    authors = [f'{makeWord(rng).title()}-{makeWord(rng).title()}' for _ in range(max(1, numPages // 4))]
+    tags = sorted({makeWord(rng) for _ in range(max(1, numPages // 4))})
+    paths = (['/'] + [f'/page/{n}/' for n in range(2, numPages // 2)]
+             + [f'/author/{author}' for author in authors]
+             + [f'/tag/{tag}/page/1/' for tag in tags])[:numPages]
+
+    for n, path in enumerate(paths):
+        quotes = []
+        for _ in range(rng.randint(3, 10)):
+            text = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(8, 40)))
+            author = rng.choice(authors)
+            quoteTags = rng.sample(tags, min(len(tags), rng.randint(1, 4)))
+            quotes.append(fixtureQuote.format(
+                text=text.capitalize(), author=author, name=author.replace('-', ' '),
+                tags=''.join(f'\n            <a class="tag" href="/tag/{tag}/page/1/">{tag}</a>'
+                             for tag in quoteTags)))
+        html = fixturePage.format(quotes=''.join(quotes), next=paths[(n + 1) % len(paths)])
+        filePath = fixtureFile(directory, path)
+        os.makedirs(os.path.dirname(filePath), exist_ok=True)
+        with open(filePath, 'w', encoding='utf-8') as f:
+            f.write(html)
+    return paths
+
+
+def fixtureFile(directory, path):
+    filePath = os.path.join(directory, path.lstrip('/'))
+    if path.endswith('/'):
+        filePath = os.path.join(filePath, 'index.html')
+    return filePath
+
+
+fixturePage = """<!DOCTYPE html>
+<html lang="en">
+<head>
+	<meta charset="UTF-8">
+	<title>Quotes to Scrape</title>
+    <link rel="stylesheet" href="/static/main.css">
+    <style>.quote {{ padding: 10px; }}</style>
+</head>
+<body>
+    <div class="container">
+        <div class="row header-box">
+            <h1><a href="/" style="text-decoration: none">Quotes to Scrape</a></h1>
+            <p><a href="/login">Login</a></p>
+        </div>
+    <!-- quotes -->
+    <div class="row">
+    <div class="col-md-8">{quotes}
+    <nav>
+        <ul class="pager">
+            <li class="next"><a href="{next}">Next <span aria-hidden="true">&rarr;</span></a></li>
+        </ul>
+    </nav>
+    </div>
+    </div>
+    </div>
+    <footer class="footer">
+        <p class="text-muted">Quotes by: <a href="https://www.goodreads.com/quotes">GoodReads.com</a></p>
+        <p class="copyright">Made with <span class='zyte'>&#10084;</span> by <a class='zyte' href="https://www.zyte.com">Zyte</a></p>
+    </footer>
+    <script>var pages = "<a href='/not-a-link'>";</script>
+</body>
+</html>
+"""
+
+fixtureQuote = """
+    <div class="quote" itemscope itemtype="http://schema.org/CreativeWork">
+        <span class="text" itemprop="text">&#8220;{text}.&#8221;</span>
+        <span>by <small class="author" itemprop="author">{name}</small>
+        <a href="/author/{author}">(about)</a>
+        </span>
+        <div class="tags">
+            Tags:
+            <meta class="keywords" itemprop="keywords" content="life" /    > {tags}
+        </div>
+    </div>"""
+
+
+def loadFixtures(directory):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, '**', '*'), recursive=True)):
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                pages.append(f.read())
+    return pages
+
+
+def benchParse(pages, repeat=3):
+    # Time each page parser over saved pages, checking they agree
+    parsers = ['bs4', 'html.parser'] + (['lxml'] if crawler.etree is not None else [])
+    expected = [crawler.parsePage(html, 'bs4') for html in pages]
+
+    print(f"Page parsing ({len(pages)} pages, "
+          f"{sum(map(len, pages)) / len(pages) / 1024:.1f} KB each)")
+    baseline = None
+    for parser in parsers:
+        assert [crawler.parsePage(html, parser) for html in pages] == expected, parser
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for html in pages:
+                crawler.parsePage(html, parser)
+        perPage = (time.perf_counter() - start) / (repeat * len(pages))
+        baseline = baseline or perPage
+        print(f"\t{parser + ':':15} {perPage * 1e3:8.2f} ms/page ({baseline / perPage:.1f}x)")
+
+    # Throughput with a process pool, as used by concurrent builds
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(crawler.parsePage, pages[:workers]))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            list(pool.map(crawler.parsePage, pages, chunksize=4))
+        perPage = (time.perf_counter() - start) / (repeat * len(pages))
+    print(f"\t{f'{workers} processes:':15} {perPage * 1e3:8.2f} ms/page ({baseline / perPage:.1f}x)")
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def serveFixtures(directory):
+    # Serve a fixture site on a free local port, yielding its base URL
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def stageCount(snapshot, name):
+    # A per stage counter, such as pagesIndexed.build, summed over stages
+    return sum(value for counter, value in snapshot['counters'].items()
+               if counter.split('.')[0] == name)
+
+
+def printStages(snapshot, stages):
+    for stage in stages:
+        timing = snapshot['timings'].get(stage)
+        if timing:
+            print(f"\t\t{stage + ':':15} {timing['total'] * 1e3:8.1f} ms total, "
+                  f"{timing['p50'] * 1e3:8.3f} ms p50, {timing['p99'] * 1e3:8.3f} ms p99")
+
+
+def buildWithParseWorkers(siteUrl, outputFile, workers=2):
+    saved = crawler.parseWorkers
+    crawler.parseWorkers = workers
+    try:
+        crawler.buildIndex(True, siteUrl, outputFile)
+    finally:
+        crawler.parseWorkers = saved
+
+
+buildModes = {
+    'sequential': lambda siteUrl, out: crawler.buildIndex(False, siteUrl, out),
+    'concurrent': lambda siteUrl, out: crawler.buildIndex(True, siteUrl, out),
+    'parseWorkers': buildWithParseWorkers,
+    'streaming': lambda siteUrl, out: crawler.buildIndexStreaming(True, siteUrl, out),
+}
+
+
+def indexContents(path):
+    # Pages, page lengths and postings of a saved index, in a form that
+    # compares equal across index formats. index.json does not keep doc
+    # IDs, so pages are compared by URL.
+    with contextlib.redirect_stdout(io.StringIO()):
+        invertedIndex = crawler.loadIndex(path)
+    docs = {invertedIndex.docUrl(docId): invertedIndex.docLength(docId)
+            for docId in range(invertedIndex.numDocs)}
+    postings = {word: {url: list(positions) for url, positions in pages.items()}
+                for word, pages in invertedIndex.items()}
+    if hasattr(invertedIndex, 'close'):
+        invertedIndex.close()
+    return docs, postings
+
+
+def checkBuilds(directory, numPages=120):
+    # Build a local fixture site in every mode and check each gives exactly
+    # the index a sequential crawl does
+    writeFixtureSite(directory, numPages)
+    crawler.crawlDelay = 0
+    crawler.requestsPerSecond = 1e9
+    with serveFixtures(directory) as siteUrl:
+        expected = None
+        for name, build in buildModes.items():
+            output = os.path.join(directory, f'{name}.index')
+            with contextlib.redirect_stdout(io.StringIO()):
+                build(siteUrl, output)
+            contents = indexContents(output)
+            expected = expected or contents
+            assert contents == expected, f"{name} build differs from sequential build"
+    print(f"Build check ({numPages} page fixture site): {', '.join(buildModes)} builds match")
+
+
+def checkUpdates(directory, numPages=120):
+    # Update an index after editing, adding and unlinking fixture pages, and
+    # check each time that it loads the same as a fresh build. Each step
+    # waits a second first: http.server compares If-Modified-Since to the
+    # second, so a page edited in the same second would answer 304.
+    paths = writeFixtureSite(directory, numPages)
+    crawler.crawlDelay = 0
+    crawler.requestsPerSecond = 1e9
+    indexPath = os.path.join(directory, 'update.json')
+    freshPath = os.path.join(directory, 'fresh.json')
+
+    def editPage(path, old, new):
+        with open(fixtureFile(directory, path), 'r', encoding='utf-8') as f:
+            html = f.read()
+        assert old in html, path
+        with open(fixtureFile(directory, path), 'w', encoding='utf-8') as f:
+            f.write(html.replace(old, new, 1))
+
+    def addPage():
+        with open(fixtureFile(directory, '/extra.html'), 'w', encoding='utf-8') as f:
+            f.write('<html><body><p>An extra page, going to mess</p></body></html>')
+        editPage('/', '</nav>', '</nav><a href="/extra.html">Extra</a>')
+
+    steps = [
+        ('edit', lambda: editPage(paths[1], '<div class="col-md-8">',
+                                  '<div class="col-md-8"><p>Zebra quagga okapi</p>')),
+        ('add', addPage),
+        ('unlink', lambda: editPage('/', '<a href="/extra.html">Extra</a>', '')),
+        ('compact', lambda: [editPage(path, '<div class="col-md-8">', '<div class="col-md-8"><p>Walrus</p>')
+                             for path in paths[:numPages // 3]]),
+    ]
+    with serveFixtures(directory) as siteUrl:
+        with contextlib.redirect_stdout(io.StringIO()):
+            crawler.buildIndex(False, siteUrl, indexPath)
+        for n, (name, change) in enumerate(steps):
+            time.sleep(1.1)
+            change()
+            with contextlib.redirect_stdout(io.StringIO()):
+                crawler.updateIndex(n % 2 == 1, siteUrl, indexPath)
+                crawler.buildIndex(False, siteUrl, freshPath)
+            assert indexContents(indexPath) == indexContents(freshPath), f"{name} update differs from fresh build"
+            compacted = not os.path.exists(crawler.indexDeltaPath(indexPath))
+            assert compacted == (name == 'compact'), f"{name} update {'compacted' if compacted else 'kept'} the delta"
+    print(f"Update check ({numPages} page fixture site): {', '.join(name for name, _ in steps)} updates match")
+
+
+def benchBuild(directory, numPages=200):
+    # Crawl a local fixture site with each build mode, politeness delays
+    # off, reporting throughput and where the time went, and checking
+    # every mode built the same index
+    writeFixtureSite(directory, numPages)
+    crawler.crawlDelay = 0
+    crawler.requestsPerSecond = 1e9
+    results = {}
+    expected = None
+    print(f"Build ({numPages} page fixture site)")
+    with serveFixtures(directory) as siteUrl:
+        for name, build in buildModes.items():
+            output = os.path.join(directory, f'{name}.index')
+            crawler.crawlStats.reset()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                build(siteUrl, output)
+                elapsed = time.perf_counter() - start
+            snapshot = crawler.crawlStats.snapshot()
+            contents = indexContents(output)
+            expected = expected or contents
+            assert contents == expected, f"{name} build differs from sequential build"
+            pages = stageCount(snapshot, 'pagesIndexed')
+            results[name] = dict(snapshot, seconds=elapsed, pagesPerSecond=pages / elapsed)
+            print(f"\t{name + ':':15} {pages / elapsed:8.1f} pages/s, "
+                  f"{snapshot['counters'].get('bytesFetched', 0) / 1e6:.2f} MB fetched, "
+                  f"{stageCount(snapshot, 'tokensIndexed')} tokens")
+            printStages(snapshot, ['fetch', 'parse', 'tokenise', 'index', 'spill', 'merge', 'serialise'])
+    return results
+
+
+def syntheticIndex(numDocs, docLength=300, vocabularySize=50000, seed=1):
+    # InvertedIndex over random pages whose word frequencies follow Zipf's
+    # law, like natural text, so posting list sizes have a realistic spread
+    rng = random.Random(seed)
+    vocabulary = list({makeWord(rng) for _ in range(vocabularySize * 2)})[:vocabularySize]
+    vocabulary.sort()
+    rng.shuffle(vocabulary)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    invertedIndex = crawler.InvertedIndex()
+    for n in range(numDocs):
+        length = rng.randint(docLength // 2, docLength * 3 // 2)
+        invertedIndex.addPage(f'https://synthetic.test/page/{n}/',
+                              rng.choices(vocabulary, cum_weights=weights, k=length))
+    return invertedIndex
+
+
+def benchCorpus(directory, numDocs, numQueries=100):
+    # Build, save, load and query a synthetic corpus in both index formats
+    crawler.crawlStats.reset()
+    start = time.perf_counter()
+    invertedIndex, size = measureMemory(lambda: syntheticIndex(numDocs))
+    elapsed = time.perf_counter() - start
+    summary = crawler.indexStats(invertedIndex)
+    print(f"Synthetic corpus ({numDocs} pages, {summary['terms']} terms, "
+          f"{invertedIndex.totalLength} tokens)")
+    print(f"\tindexing:       {numDocs / elapsed:8.1f} pages/s, {size / 1e6:.1f} MB in memory")
+    print(f"\tposting lists:  p50 {summary['postingListSize']['p50']}, "
+          f"p99 {summary['postingListSize']['p99']}, max {summary['postingListSize']['max']}")
+
+    jsonPath = os.path.join(directory, 'synthetic.json')
+    binaryPath = os.path.join(directory, 'synthetic.bin')
+    with crawler.crawlStats.timer('saveJson'), open(jsonPath, 'w') as f:
+        json.dump(invertedIndex.toDict(), f, indent=2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        crawler.convertIndex(jsonPath, binaryPath)
+    queries = sampleQueries + sampleLongQueries(invertedIndex, count=numQueries)
+
+    results = {'index': summary}
+    for name, path in (('json', jsonPath), ('binary', binaryPath)):
+        crawler.crawlStats.reset()
+        with contextlib.redirect_stdout(io.StringIO()):
+            loaded = crawler.loadIndex(path)
+        for query in queries:
+            crawler.findMatches(query, loaded)
+            crawler.searchIndex(query, loaded)
+        snapshot = crawler.crawlStats.snapshot()
+        results[name] = dict(snapshot, fileBytes=os.path.getsize(path))
+        print(f"\t{name} ({os.path.getsize(path) / 1e6:.1f} MB):")
+        printStages(snapshot, ['load', 'find', 'search'])
+        if hasattr(loaded, 'close'):
+            loaded.close()
+    return results
+
+
+def benchIndexFile(path, fixtureDir=None):
+    # Workloads against a crawled index and saved pages
+    dictIndex, packedIndex = benchIndexLayout(path)
+    benchPhraseMatch(dictIndex, packedIndex)
+    benchSearch(packedIndex)
+    with tempfile.TemporaryDirectory() as directory:
+        if fixtureDir is None:
+            writeFixtureSite(directory)
+        benchParse(loadFixtures(fixtureDir or directory))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark index builds, loads and queries.")
+    parser.add_argument('workloads', nargs='*', default=['check', 'index', 'build', 'corpus'],
+                        choices=['check', 'index', 'build', 'corpus'],
+                        help="check: every build mode, and updates, give the same index; index: layout, phrase, "
+                             "search and parse timings against a saved index; build: crawl a local "
+                             "fixture site; corpus: a synthetic corpus")
+    parser.add_argument('--index', default=crawler.indexFile, help="saved JSON index for the index workload")
+    parser.add_argument('--fixtures', help="directory of saved pages for the parse timings")
+    parser.add_argument('--pages', type=int, default=200, help="fixture site size for the build workload")
+    parser.add_argument('--docs', type=int, default=5000, help="synthetic corpus size")
+    parser.add_argument('--json', help="write build and corpus results as JSON to this file")
+    options = parser.parse_args()
+
+    results = {}
+    if 'check' in options.workloads:
+        with tempfile.TemporaryDirectory() as directory:
+            checkBuilds(directory)
+        with tempfile.TemporaryDirectory() as directory:
+            checkUpdates(directory)
+    if 'index' in options.workloads:
+        benchIndexFile(options.index, options.fixtures)
+    with tempfile.TemporaryDirectory() as directory:
+        if 'build' in options.workloads:
+            results['build'] = benchBuild(os.path.join(directory, 'site'), options.pages)
+        if 'corpus' in options.workloads:
+            results['corpus'] = benchCorpus(directory, options.docs)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,69 +1,1295 @@
 from bs4 import BeautifulSoup
-from collections import deque
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urlparse
 import requests
+import requests.adapters
+import contextlib
+import cProfile
+import pstats
+import functools
+import hashlib
+import itertools
+import heapq
+import math
+import threading
+import argparse
+import shutil
+import struct
 import json
+import mmap
+import io
 import time
 import sys
 import os
 import re
 
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
 baseUrl = "https://quotes.toscrape.com"
 indexFile = "index.json"
+binaryIndexFile = "index.bin"
+pageRecordsSuffix = ".pages.json"  # page records saved beside an index
+indexDeltaSuffix = ".delta.json"  # pages changed by updates since the index was written
+deltaCompactionRatio = 0.25  # delta size, as a fraction of pages, at which updates rewrite the index
+streamingMemoryBudget = 64 * 1024 * 1024  # postings buffered before a run is spilled
+runEntryOverhead = 220  # bytes a buffered (term, doc ID, positions) entry costs
+checkpointPages = 100  # pages between checkpoints of a streaming build
+checkpointSeconds = 60  # seconds between checkpoints of a streaming build
+mergeFanIn = 64  # run files a streaming build merges at once
+postingsChunkSize = 1 << 16  # encoded postings a term buffers before streaming them out
 
+crawlDelay = 6  # seconds between requests to a host in a sequential build
+maxWorkers = 8  # requests in flight in a concurrent build
+requestsPerSecond = 4  # per-host request rate in a concurrent build
+concurrentCrawlDelay = 0  # minimum gap between requests in a concurrent build
+fetchTimeout = 30  # seconds to wait for a server to connect or send data
+pageParser = "html.parser"  # page text extractor: "html.parser", "lxml" or "bs4"
+parseWorkers = 0  # processes parsing pages in a concurrent build, 0 parses on the fetch threads
 
-def buildIndex():
-    invertedIndex = {}
-    urlQueue = deque(['/'])  # queue for pages to crawl
-    visitedUrls = set()
+topK = 10  # results shown by the search command
+bm25K1 = 1.2  # BM25 term frequency saturation
+bm25B = 0.75  # BM25 document length normalisation
+queryCacheSize = 256  # queries and phrases kept by a QueryCache
+batchQueryField = "query"  # field holding the query in JSON batch input
 
-    while urlQueue:
-        pagePath = urlQueue.popleft()
-        if pagePath in visitedUrls:
-            continue
 
-        visitedUrls.add(pagePath)
+class LatencyHistogram:
+    # Latencies in log-scale buckets, four per doubling from 1 microsecond,
+    # so percentiles are within about 19% however many samples there are
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
 
-        fullUrl = baseUrl + pagePath
-        print(f'Crawling: {fullUrl}')
+    def record(self, seconds):
+        bucket = int(math.log2(max(seconds, 1e-6) * 1e6) * 4)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        # Upper edge of the bucket holding the given fraction of samples
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= fraction * self.count:
+                return min(self.max, 2 ** ((bucket + 1) / 4) / 1e6)
+        return self.max
+
+    def merge(self, other):
+        # Add in the samples of another histogram's vars()
+        for bucket, count in other['buckets'].items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other['count']
+        self.total += other['total']
+        self.max = max(self.max, other['max'])
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class Stats:
+    # Counters and per-stage latency histograms for builds, loads and
+    # queries, shown by the stats command. Stages can nest: build covers
+    # fetch, parse and index, and parse covers tokenise. Page and token
+    # counts are kept per build stage, e.g. pagesIndexed.build.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, stage, seconds):
+        with self.lock:
+            histogram = self.timings.get(stage)
+            if histogram is None:
+                histogram = self.timings[stage] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def drain(self):
+        # Everything recorded so far as plain data for merge(), clearing it;
+        # how worker processes hand their stats back
+        with self.lock:
+            data = {'counters': self.counters,
+                    'timings': {stage: vars(histogram) for stage, histogram in self.timings.items()}}
+            self.reset()
+        return data
+
+    def merge(self, data):
+        with self.lock:
+            for name, amount in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            for stage, histogram in data['timings'].items():
+                if stage not in self.timings:
+                    self.timings[stage] = LatencyHistogram()
+                self.timings[stage].merge(histogram)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timings = {stage: histogram.summary() for stage, histogram in self.timings.items()}
+        rates = {}
+        for stage, pages in (('build', 'pagesIndexed.build'), ('update', 'pagesVisited.update'),
+                             ('streamingBuild', 'pagesIndexed.streamingBuild')):
+            if stage in timings and timings[stage]['total']:
+                rates[stage + 'PagesPerSecond'] = counters.get(pages, 0) / timings[stage]['total']
+        if 'fetch' in timings and timings['fetch']['total']:
+            rates['fetchBytesPerSecond'] = counters.get('bytesFetched', 0) / timings['fetch']['total']
+        return {'counters': counters, 'timings': timings, 'rates': rates}
+
+
+crawlStats = Stats()
+
+
+def timed(stage):
+    # Decorator recording every call of a function under stage in crawlStats
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with crawlStats.timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def indexStats(invertedIndex):
+    # Size of an index and the spread of its posting list lengths
+    sizes = sorted(invertedIndex.docFrequencies())
+    if not sizes:
+        return {'terms': 0, 'docs': invertedIndex.numDocs, 'postings': 0}
+    return {
+        'terms': len(sizes),
+        'docs': invertedIndex.numDocs,
+        'postings': sum(sizes),
+        'postingListSize': {
+            'mean': sum(sizes) / len(sizes),
+            'p50': sizes[len(sizes) // 2],
+            'p99': sizes[min(len(sizes) - 1, int(len(sizes) * 0.99))],
+            'max': sizes[-1],
+        },
+    }
+
+
+def printStats(invertedIndex=None):
+    snapshot = crawlStats.snapshot()
+    if not snapshot['counters'] and not snapshot['timings']:
+        print("No statistics recorded yet.")
+    if snapshot['counters']:
+        print("Counters:")
+        for name, value in sorted(snapshot['counters'].items()):
+            print(f"\t{name:20} {value}")
+    if snapshot['timings']:
+        print("Timings (calls, total s, p50 ms, p99 ms, max ms):")
+        for stage, timing in sorted(snapshot['timings'].items()):
+            print(f"\t{stage:20} {timing['count']:8} {timing['total']:10.3f} "
+                  f"{timing['p50'] * 1e3:10.3f} {timing['p99'] * 1e3:10.3f} {timing['max'] * 1e3:10.3f}")
+    for name, value in sorted(snapshot['rates'].items()):
+        print(f"{name}: {value:.1f}")
+    if invertedIndex is not None:
+        summary = indexStats(invertedIndex)
+        print(f"Index: {summary['terms']} terms, {summary['docs']} pages, {summary['postings']} postings")
+        if 'postingListSize' in summary:
+            sizes = summary['postingListSize']
+            print(f"Posting list size: mean {sizes['mean']:.1f}, p50 {sizes['p50']}, "
+                  f"p99 {sizes['p99']}, max {sizes['max']}")
+
+
+def dumpStats(invertedIndex=None, path=None):
+    # Stats as JSON, to path or stdout
+    snapshot = crawlStats.snapshot()
+    if invertedIndex is not None:
+        snapshot['index'] = indexStats(invertedIndex)
+    if path:
+        with open(path, 'w') as f:
+            json.dump(snapshot, f, indent=2)
+    else:
+        print(json.dumps(snapshot, indent=2))
+
+
+# cProfile session started by the profile command
+profiler = None
+
+
+def startProfile():
+    global profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+
+def stopProfile(path=None):
+    # Stop profiling and print the top functions, saving the raw profile
+    # to path for pstats or snakeviz if given
+    global profiler
+    profiler.disable()
+    if path:
+        profiler.dump_stats(path)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    profiler = None
+
+
+@timed('build')
+def buildIndex(concurrent=False, siteUrl=None, outputFile=None):
+    invertedIndex = InvertedIndex()
+    pageRecords = {}
+
+    def visitPage(fullUrl, session, parse):
+        response = fetchPage(fullUrl, session)
+        words, links = parse(response.text)
+        return (words, makePageRecord(response, words, links)), links
+
+    for fullUrl, (words, record) in crawlSite(siteUrl or baseUrl, visitPage, concurrent):
+        invertedIndex.addPage(fullUrl, words)
+        crawlStats.count('pagesIndexed.build')
+        crawlStats.count('tokensIndexed.build', len(words))
+        pageRecords[fullUrl] = record
+
+    # save to JSON file
+    with crawlStats.timer('serialise'), open(outputFile or indexFile, 'w') as f:
+        json.dump(invertedIndex.toDict(), f, indent=2)
+    savePageRecords(pageRecords, outputFile)
+    if os.path.exists(indexDeltaPath(outputFile)):
+        os.remove(indexDeltaPath(outputFile))
+
+
+@timed('update')
+def updateIndex(concurrent=False, siteUrl=None, outputFile=None):
+    # Recrawl the site and record only what changed. Pages are requested
+    # with the ETag/Last-Modified seen last time; pages answering 304, or
+    # with the same content hash as before, are not parsed. Changed and
+    # removed pages go into the index's delta file (see loadIndexDelta),
+    # so an update writes work proportional to the changes, until the
+    # delta passes deltaCompactionRatio of the site and the index is
+    # rewritten with it applied. Without page records from an earlier
+    # build this is the same as a full build.
+    outputFile = outputFile or indexFile
+    oldRecords = loadPageRecords(outputFile)
+    if oldRecords is None or not os.path.exists(outputFile):
+        buildIndex(concurrent, siteUrl, outputFile)
+        return
 
-        # Get text and tokenise
-        html = fetchPage(fullUrl)
-        soup = BeautifulSoup(html, 'html.parser')
-        pageText = soup.get_text()
-        words = removePunctuation(pageText)
+    delta = loadIndexDelta(outputFile) or {}
+    pageRecords = {}
+    changed = 0
 
-        # Record word positions in the inverted index
+    def recordChange(url, words):
+        # baseTerms are the page's words in the index file itself, which
+        # loading removes before the page's latest words are added
+        change = delta.get(url)
+        baseTerms = change['baseTerms'] if change else oldRecords.get(url, {}).get('terms')
+        delta[url] = {'words': words, 'baseTerms': baseTerms}
+
+    def visitPage(fullUrl, session, parse):
+        record = oldRecords.get(fullUrl)
+        response = fetchPage(fullUrl, session, record)
+        if record and response.status_code == 304:
+            return (None, record), record['links']
+        if record and hashlib.sha1(response.content).hexdigest() == record['hash']:
+            return (None, dict(record, etag=response.headers.get('ETag'),
+                               lastModified=response.headers.get('Last-Modified'))), record['links']
+        words, links = parse(response.text)
+        return (words, makePageRecord(response, words, links)), links
+
+    for fullUrl, (words, record) in crawlSite(siteUrl or baseUrl, visitPage, concurrent):
+        pageRecords[fullUrl] = record
+        crawlStats.count('pagesVisited.update')
+        if words is not None:
+            recordChange(fullUrl, words)
+            changed += 1
+            crawlStats.count('pagesChanged.update')
+            crawlStats.count('tokensIndexed.update', len(words))
+
+    # Drop pages that are no longer linked from the site
+    removed = [url for url in oldRecords if url not in pageRecords]
+    for url in removed:
+        recordChange(url, None)
+
+    print(f"Updated index: {changed} pages changed, "
+          f"{len(pageRecords) - changed} unchanged, {len(removed)} removed.")
+    # The delta is saved before the records, so a crash between the two
+    # only means the next update fetches the same changes again. The
+    # records are saved before compacting, as the compacted index only
+    # matches the new records.
+    if changed or removed:
+        with crawlStats.timer('serialise'):
+            saveIndexDelta(delta, outputFile)
+    if pageRecords != oldRecords:
+        savePageRecords(pageRecords, outputFile)
+    if (changed or removed) and len(delta) > deltaCompactionRatio * len(pageRecords):
+        compactIndex(outputFile)
+
+
+def indexDeltaPath(outputFile):
+    return os.path.splitext(outputFile or indexFile)[0] + indexDeltaSuffix
+
+
+def indexSignature(path):
+    # Identifies one write of an index file, so a delta is only applied to
+    # the index it was recorded against
+    info = os.stat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+
+def loadIndexDelta(path=None):
+    # {url: {'words': latest words or None if removed, 'baseTerms': words
+    # in the index file}} for the pages updates changed since the index
+    # at path was written, or None if there are none
+    deltaPath = indexDeltaPath(path)
+    if not os.path.exists(deltaPath):
+        return None
+    with open(deltaPath, 'r') as f:
+        delta = json.load(f)
+    if delta['base'] != indexSignature(path or indexFile):
+        return None
+    return delta['pages']
+
+
+def saveIndexDelta(delta, path=None):
+    with open(indexDeltaPath(path) + '.tmp', 'w') as f:
+        json.dump({'base': indexSignature(path or indexFile), 'pages': delta}, f)
+    os.replace(indexDeltaPath(path) + '.tmp', indexDeltaPath(path))
+
+
+def applyIndexDelta(data, delta):
+    # Apply a delta to the {word: {url: positions}} layout of index.json,
+    # before it is packed, so each affected term is only built once
+    for url, change in delta.items():
+        for word in change['baseTerms'] or ():
+            pages = data.get(word)
+            if pages is not None:
+                pages.pop(url, None)
+                if not pages:
+                    del data[word]
+        for pos, word in enumerate(change['words'] or ()):
+            data.setdefault(word, {}).setdefault(url, []).append(pos)
+
+
+def readJsonIndex(path):
+    # A JSON index with its update delta, if any, applied
+    with open(path, 'r') as f:
+        data = json.load(f)
+    delta = loadIndexDelta(path)
+    if delta:
+        applyIndexDelta(data, delta)
+    return InvertedIndex.fromDict(data)
+
+
+def compactIndex(path):
+    # Rewrite a JSON index with its delta applied. The new file no longer
+    # matches the delta's signature, so a crash before the delta is
+    # deleted cannot apply it twice.
+    invertedIndex = readJsonIndex(path)
+    with crawlStats.timer('serialise'), open(path + '.tmp', 'w') as f:
+        json.dump(invertedIndex.toDict(), f, indent=2)
+    os.replace(path + '.tmp', path)
+    os.remove(indexDeltaPath(path))
+
+
+@timed('streamingBuild')
+def buildIndexStreaming(concurrent=False, siteUrl=None, outputFile=None, memoryBudget=None):
+    # Build a binary index with bounded memory. Postings are buffered per
+    # page and, once they pass memoryBudget bytes, sorted by term and
+    # spilled to a run file; at the end the runs are merged, at most
+    # mergeFanIn at a time, straight into the index file. The crawl queue
+    # is checkpointed with every run, and a run is also spilled every
+    # checkpointPages pages or checkpointSeconds seconds, so an interrupted
+    # build resumes from its last checkpoint instead of page one. Queued
+    # paths and page lengths are appended to log files as they are
+    # checkpointed, so the checkpoint itself only holds counts and runs.
+    siteUrl = siteUrl or baseUrl
+    outputFile = outputFile or binaryIndexFile
+    memoryBudget = memoryBudget or streamingMemoryBudget
+    buildDir = outputFile + '.build'
+    checkpointPath = os.path.join(buildDir, 'checkpoint.json')
+    discoveredLog = os.path.join(buildDir, 'discovered.log')  # JSON path per line
+    docLengthsLog = os.path.join(buildDir, 'docLengths.bin')  # u32 per page
+
+    # Doc IDs are crawl positions, so discovered[:numPages] are the doc URLs
+    state = {'siteUrl': siteUrl, 'numPages': 0, 'numDiscovered': 0, 'discoveredBytes': 0, 'runs': []}
+    if os.path.exists(checkpointPath):
+        with open(checkpointPath, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint['siteUrl'] == siteUrl:
+            state = checkpoint
+            print(f"Resuming build after {state['numPages']} pages.")
+    os.makedirs(buildDir, exist_ok=True)
+
+    # Anything logged after the last checkpoint is dropped and redone
+    discovered = ['/']
+    docLengths = array('I')
+    if state['numPages']:
+        os.truncate(discoveredLog, state['discoveredBytes'])
+        os.truncate(docLengthsLog, state['numPages'] * docLengths.itemsize)
+        with open(discoveredLog, 'rb') as f:
+            discovered = [json.loads(line) for line in f]
+        with open(docLengthsLog, 'rb') as f:
+            docLengths.fromfile(f, state['numPages'])
+    else:
+        open(discoveredLog, 'wb').close()
+        open(docLengthsLog, 'wb').close()
+    runs = state['runs']
+    buffer = []  # (term, doc ID, positions)
+    bufferBytes = 0
+    lastCheckpoint = time.monotonic()
+
+    def flush():
+        nonlocal buffer, bufferBytes, lastCheckpoint
+        if buffer:
+            runPath = os.path.join(buildDir, f'run-{len(runs):05d}.bin')
+            with crawlStats.timer('spill'):
+                buffer.sort(key=lambda entry: entry[0])
+                writeRun(runPath, buffer)
+            runs.append(runPath)
+            crawlStats.count('runsSpilled')
+            buffer, bufferBytes = [], 0
+        with open(discoveredLog, 'ab') as f:
+            for path in discovered[state['numDiscovered']:]:
+                f.write(json.dumps(path).encode('utf-8') + b'\n')
+            state['discoveredBytes'] = f.tell()
+        with open(docLengthsLog, 'ab') as f:
+            docLengths[state['numPages']:].tofile(f)
+        state['numDiscovered'] = len(discovered)
+        state['numPages'] = len(docLengths)
+        writeCheckpoint(checkpointPath, state)
+        lastCheckpoint = time.monotonic()
+
+    def visitPage(fullUrl, session, parse):
+        return parse(fetchPage(fullUrl, session).text)
+
+    pages = crawlSite(siteUrl, visitPage, concurrent, discovered, state['numPages'])
+    for docId, (fullUrl, words) in enumerate(pages, state['numPages']):
+        pagePositions = {}
         for pos, word in enumerate(words):
-            if word not in invertedIndex:
-                invertedIndex[word] = {fullUrl: [pos]}
+            pagePositions.setdefault(word, array('I')).append(pos)
+        with crawlStats.timer('index'):
+            for word, positions in pagePositions.items():
+                term = word.encode('utf-8')
+                buffer.append((term, docId, positions))
+                bufferBytes += runEntryOverhead + len(term) + positions.itemsize * len(positions)
+        docLengths.append(len(words))
+        crawlStats.count('pagesIndexed.streamingBuild')
+        crawlStats.count('tokensIndexed.streamingBuild', len(words))
+        if (bufferBytes >= memoryBudget or len(docLengths) - state['numPages'] >= checkpointPages
+                or time.monotonic() - lastCheckpoint >= checkpointSeconds):
+            flush()
+    flush()
+
+    # Merge passes bring the runs down to mergeFanIn, so the number of
+    # open files stays bounded however many runs were spilled. Each pass
+    # is checkpointed before its inputs are deleted.
+    while len(runs) > mergeFanIn:
+        state['mergePasses'] = state.get('mergePasses', 0) + 1
+        mergedRuns = []
+        with crawlStats.timer('merge'):
+            for n in range(0, len(runs), mergeFanIn):
+                runPath = os.path.join(buildDir, f"merge-{state['mergePasses']}-{len(mergedRuns):05d}.bin")
+                writeRun(runPath, mergeRuns(runs[n:n + mergeFanIn]))
+                mergedRuns.append(runPath)
+        inputRuns, runs[:] = runs[:], mergedRuns
+        writeCheckpoint(checkpointPath, state)
+        for runPath in inputRuns:
+            os.remove(runPath)
+
+    terms = ((term.decode('utf-8'), ((docId, positions) for _, docId, positions in entries))
+             for term, entries in itertools.groupby(mergeRuns(runs), key=lambda entry: entry[0]))
+    with crawlStats.timer('merge'):
+        writeBinaryIndex(outputFile, [siteUrl + path for path in discovered[:len(docLengths)]],
+                         docLengths, terms)
+    shutil.rmtree(buildDir)
+
+
+def mergeRuns(paths):
+    # Runs hold ascending doc IDs per term, so merging on (term, doc ID)
+    # yields each term's complete posting list in order
+    return heapq.merge(*map(readRun, paths), key=lambda entry: entry[:2])
+
+
+def writeCheckpoint(path, state):
+    # Replace the checkpoint atomically so a crash leaves the old one intact
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def makePageRecord(response, words, links):
+    # What updateIndex needs to know about a page without refetching it
+    return {
+        'etag': response.headers.get('ETag'),
+        'lastModified': response.headers.get('Last-Modified'),
+        'hash': hashlib.sha1(response.content).hexdigest(),
+        'links': links,
+        'terms': sorted(set(words)),
+    }
+
+
+def pageRecordsPath(outputFile):
+    # Page records are kept next to the index they describe
+    return os.path.splitext(outputFile or indexFile)[0] + pageRecordsSuffix
+
+
+def loadPageRecords(outputFile=None):
+    path = pageRecordsPath(outputFile)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def savePageRecords(pageRecords, outputFile=None):
+    # Replaced atomically, as a torn records file would fail every update
+    path = pageRecordsPath(outputFile)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(pageRecords, f)
+    os.replace(path + '.tmp', path)
+
+
+def crawlSite(siteUrl, visitPage, concurrent=False, discovered=None, start=0):
+    # Breadth-first crawl from '/'. visitPage(url, session, parse) fetches a
+    # page, tokenises it with parse(html) and returns (result, links);
+    # (url, result) pairs are yielded in the order pages are discovered. In
+    # concurrent mode up to maxWorkers pages are fetched ahead of the one
+    # being yielded, so the output order (and therefore the index) is the
+    # same as a sequential crawl, and with parseWorkers set pages are parsed
+    # in other processes while fetching continues. A crawl is resumed by
+    # passing back the discovered list and the number of pages already
+    # yielded from it.
+    if concurrent:
+        # Bounded pool of fetchers sharing pooled connections, throttled per host
+        workers = maxWorkers
+        limiter = HostRateLimiter(rate=requestsPerSecond, burst=maxWorkers,
+                                  crawlDelay=concurrentCrawlDelay)
+    else:
+        workers = 1
+        limiter = HostRateLimiter(crawlDelay=crawlDelay)
+    session = makeSession(workers)
+
+    if discovered is None:
+        discovered = ['/']  # pages in crawl order, queued or visited
+    seenUrls = set(discovered)
+    pending = {}
+
+    parsePool = ProcessPoolExecutor(max_workers=parseWorkers) if concurrent and parseWorkers else None
+
+    def parse(html):
+        if parsePool:
+            # Timed here as the worker processes keep their own stats
+            with crawlStats.timer('parse'):
+                return parsePool.submit(parsePage, html, pageParser).result()
+        return parsePage(html)
+
+    def crawlPage(pagePath):
+        fullUrl = siteUrl + pagePath
+        limiter.acquire(fullUrl)
+        print(f'Crawling: {fullUrl}')
+        return fullUrl, visitPage(fullUrl, session, parse)
+
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for i in itertools.count(start):
+            if i >= len(discovered):
+                break
+            pagePath = discovered[i]
+            if pool:
+                # Keep the window of in-flight requests full
+                for ahead in range(i, min(i + workers, len(discovered))):
+                    if ahead not in pending:
+                        pending[ahead] = pool.submit(crawlPage, discovered[ahead])
+                fullUrl, (result, links) = pending.pop(i).result()
             else:
-                if fullUrl not in invertedIndex[word]:
-                    invertedIndex[word][fullUrl] = [pos]
-                else:
-                    invertedIndex[word][fullUrl].append(pos)
+                fullUrl, (result, links) = crawlPage(pagePath)
 
-        # Queue new links for crawling
-        for link in soup.find_all('a'):
-            href = link.get('href')
-            if href and href.startswith('/') and href not in visitedUrls and href not in urlQueue:
-                urlQueue.append(href)
+            # Queue new links for crawling
+            for href in links:
+                if href.startswith('/') and href not in seenUrls:
+                    seenUrls.add(href)
+                    discovered.append(href)
 
-        time.sleep(6)
+            yield fullUrl, result
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        if parsePool:
+            parsePool.shutdown(cancel_futures=True)
 
-    # save to JSON file
-    with open(indexFile, 'w') as f:
-        json.dump(invertedIndex, f, indent=2)
 
+def parsePage(html, parser=None):
+    # Get text and tokenise, and collect the hrefs of all links. The
+    # single-pass extractors give the same words and links as BeautifulSoup
+    # without building a tree. "lxml" is faster but can differ on broken
+    # markup (it keeps the first of duplicate attributes and drops CDATA),
+    # and falls back to "html.parser" when lxml is not installed.
+    parser = parser or pageParser
+    if parser == "bs4":
+        with crawlStats.timer('parse'):
+            soup = BeautifulSoup(html, 'html.parser')
+            text = soup.get_text()
+            links = [link.get('href') for link in soup.find_all('a')]
+            links = [href for href in links if href]
+    else:
+        with crawlStats.timer('parse'):
+            if parser == "lxml" and etree is not None:
+                extractor = LxmlPageExtractor()
+                etree.HTML(html, etree.HTMLParser(target=extractor))
+            else:
+                extractor = PageExtractor()
+                extractor.feed(html)
+                extractor.close()
+            text = ''.join(extractor.text)
+            links = extractor.links
+    with crawlStats.timer('tokenise'):
+        words = removePunctuation(text)
+    return words, links
+
+
+# Tags whose text BeautifulSoup's get_text() leaves out
+hiddenTextTags = {'script', 'style', 'template', 'rt', 'rp'}
+
+
+class PageExtractor(HTMLParser):
+    # Streaming html.parser pass collecting the page text, as get_text()
+    # would join it, and the href of every link
+    def __init__(self):
+        super().__init__()
+        self.text = []
+        self.links = []
+        self.hiddenDepth = 0  # open tags whose text is left out
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+        if tag in hiddenTextTags:
+            self.hiddenDepth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        # <a href="..."/> is still a link, but opens nothing
+        if tag == 'a':
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in hiddenTextTags and self.hiddenDepth:
+            self.hiddenDepth -= 1
+
+    def handle_data(self, data):
+        if not self.hiddenDepth:
+            self.text.append(data)
+
+    def unknown_decl(self, data):
+        # CDATA sections count as text, other declarations do not
+        if data.upper().startswith('CDATA['):
+            self.handle_data(data[len('CDATA['):])
+
+
+class LxmlPageExtractor:
+    # Parser target for lxml's HTML parser, collecting the same as PageExtractor
+    def __init__(self):
+        self.text = []
+        self.links = []
+        self.hiddenDepth = 0
+
+    def start(self, tag, attrib):
+        if tag == 'a' and attrib.get('href'):
+            self.links.append(attrib['href'])
+        if tag in hiddenTextTags:
+            self.hiddenDepth += 1
+
+    def end(self, tag):
+        if tag in hiddenTextTags and self.hiddenDepth:
+            self.hiddenDepth -= 1
+
+    def data(self, data):
+        if not self.hiddenDepth:
+            self.text.append(data)
+
+    def close(self):
+        pass
+
+
+class InvertedIndex:
+    # In-memory inverted index. Each URL is interned once as an integer doc
+    # ID and every term's postings live in packed arrays (see TermPostings).
+    # Reads look like the {word: {url: positions}} dict stored in index.json.
+    def __init__(self):
+        self.docUrls = []  # doc ID -> URL
+        self.docIds = {}  # URL -> doc ID
+        self.docLengths = array('I')  # doc ID -> number of words
+        self.docIndexed = bytearray()  # doc ID -> 1 while the page is indexed
+        self.numDocs = 0
+        self.totalLength = 0
+        self.terms = {}  # word -> TermPostings
+        self.version = 0  # bumped on every change, see QueryCache
+
+    @classmethod
+    def fromDict(cls, data):
+        # Build from the {word: {url: positions}} layout of index.json.
+        # Every word of a page has a position, so a page's length is one
+        # past its last position.
+        invertedIndex = cls()
+        docLengths = invertedIndex.docLengths
+        for word, pages in data.items():
+            postings = TermPostings(invertedIndex)
+            for docId, positions in sorted(
+                    (invertedIndex.internDoc(page), poss) for page, poss in pages.items()):
+                postings.append(docId, positions)
+                if positions:
+                    docLengths[docId] = max(docLengths[docId], positions[-1] + 1)
+            invertedIndex.terms[word] = postings
+        invertedIndex.docIndexed = bytearray(b'\1' * len(invertedIndex.docUrls))
+        invertedIndex.numDocs = len(invertedIndex.docUrls)
+        invertedIndex.totalLength = sum(docLengths)
+        return invertedIndex
+
+    def toDict(self):
+        return {word: {page: list(poss) for page, poss in postings.items()}
+                for word, postings in self.terms.items()}
+
+    def internDoc(self, url):
+        docId = self.docIds.get(url)
+        if docId is None:
+            docId = self.docIds[url] = len(self.docUrls)
+            self.docUrls.append(url)
+            self.docLengths.append(0)
+            self.docIndexed.append(0)
+        return docId
+
+    def docUrl(self, docId):
+        return self.docUrls[docId]
+
+    def docIdOf(self, url):
+        return self.docIds.get(url)
+
+    def docLength(self, docId):
+        return self.docLengths[docId]
+
+    @timed('index')
+    def addPage(self, fullUrl, words):
+        # Record word positions in the inverted index, replacing any
+        # postings the page already has
+        docId = self.internDoc(fullUrl)
+        if self.docIndexed[docId]:
+            self.removePage(fullUrl)
+        self.docIndexed[docId] = 1
+        self.version += 1
+        self.docLengths[docId] = len(words)
+        self.numDocs += 1
+        self.totalLength += len(words)
+        pagePositions = {}
+        for pos, word in enumerate(words):
+            pagePositions.setdefault(word, []).append(pos)
+
+        for word, positions in pagePositions.items():
+            postings = self.terms.get(word)
+            if postings is None:
+                postings = self.terms[word] = TermPostings(self)
+            postings.insert(docId, positions)
 
-def loadIndex():
-    # Load the inverted index from file
-    if not os.path.exists(indexFile):
+    def removePage(self, fullUrl, words=None):
+        # Drop a page's postings. words, the page's distinct words when it
+        # was indexed, limits the work to those terms; without it every
+        # term is checked.
+        docId = self.docIds.get(fullUrl)
+        if docId is None or not self.docIndexed[docId]:
+            return
+        for word in list(self.terms) if words is None else words:
+            postings = self.terms.get(word)
+            if postings is not None and postings.remove(docId) and not postings:
+                del self.terms[word]
+        self.docIndexed[docId] = 0
+        self.version += 1
+        self.numDocs -= 1
+        self.totalLength -= self.docLengths[docId]
+        self.docLengths[docId] = 0
+
+    def docFrequencies(self):
+        return (len(postings) for postings in self.terms.values())
+
+    def get(self, word, default=None):
+        return self.terms.get(word, default)
+
+    def __getitem__(self, word):
+        return self.terms[word]
+
+    def __contains__(self, word):
+        return word in self.terms
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def keys(self):
+        return self.terms.keys()
+
+    def items(self):
+        return self.terms.items()
+
+
+class TermPostings(Mapping):
+    # Postings of one term as three packed arrays: ascending doc IDs, the
+    # start of each doc's run in positions, and all positions back to back.
+    # Behaves as a read-only {url: positions} mapping.
+    __slots__ = ('docs', 'docIds', 'offsets', 'positions')
+
+    def __init__(self, docs, docIds=None, offsets=None, positions=None):
+        self.docs = docs  # resolves doc IDs to URLs and back
+        self.docIds = docIds if docIds is not None else array('I')
+        self.offsets = offsets if offsets is not None else array('I', [0])
+        self.positions = positions if positions is not None else array('I')
+
+    def append(self, docId, positions):
+        # Add a doc's positions; doc IDs must be added in ascending order
+        self.docIds.append(docId)
+        self.positions.extend(positions)
+        self.offsets.append(len(self.positions))
+
+    def insert(self, docId, positions):
+        # Add a doc's positions in doc ID order; the doc must not be present
+        i = bisect_left(self.docIds, docId)
+        if i == len(self.docIds):
+            self.append(docId, positions)
+            return
+        count = len(positions)
+        self.docIds.insert(i, docId)
+        self.positions[self.offsets[i]:self.offsets[i]] = array('I', positions)
+        for j in range(i + 1, len(self.offsets)):
+            self.offsets[j] += count
+        self.offsets.insert(i + 1, self.offsets[i] + count)
+
+    def remove(self, docId):
+        # Drop a doc's positions, returning whether it was present
+        i = self.findDoc(docId)
+        if i < 0:
+            return False
+        start, end = self.offsets[i], self.offsets[i + 1]
+        del self.positions[start:end]
+        del self.docIds[i]
+        del self.offsets[i + 1]
+        for j in range(i + 1, len(self.offsets)):
+            self.offsets[j] -= end - start
+        return True
+
+    def positionsAt(self, i):
+        # Positions of the i-th doc in this posting list
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def frequencyAt(self, i):
+        # Number of positions of the i-th doc
+        return self.offsets[i + 1] - self.offsets[i]
+
+    def findDoc(self, docId):
+        # Index of docId in this posting list, or -1
+        i = bisect_left(self.docIds, docId)
+        if i < len(self.docIds) and self.docIds[i] == docId:
+            return i
+        return -1
+
+    def get(self, url, default=None):
+        docId = self.docs.docIdOf(url)
+        i = -1 if docId is None else self.findDoc(docId)
+        return default if i < 0 else self.positionsAt(i)
+
+    def __getitem__(self, url):
+        positions = self.get(url)
+        if positions is None:
+            raise KeyError(url)
+        return positions
+
+    def __len__(self):
+        return len(self.docIds)
+
+    def __iter__(self):
+        for docId in self.docIds:
+            yield self.docs.docUrl(docId)
+
+    def items(self):
+        for i, docId in enumerate(self.docIds):
+            yield self.docs.docUrl(docId), self.positionsAt(i)
+
+
+class HostRateLimiter:
+    # Per-host token bucket: at most `burst` requests back to back, refilled
+    # at `rate` tokens per second (unlimited if rate is None), and never two
+    # requests to the same host less than `crawlDelay` seconds apart.
+    def __init__(self, rate=None, burst=1, crawlDelay=0):
+        self.rate = rate
+        self.burst = burst
+        self.crawlDelay = crawlDelay
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    @timed('politenessWait')
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                state = self.hosts.setdefault(
+                    host, {'tokens': self.burst, 'updated': now, 'last': None})
+                wait = 0
+                if self.rate:
+                    state['tokens'] = min(
+                        self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+                    state['updated'] = now
+                    if state['tokens'] < 1:
+                        wait = (1 - state['tokens']) / self.rate
+                if state['last'] is not None:
+                    wait = max(wait, state['last'] + self.crawlDelay - now)
+                if wait <= 0:
+                    if self.rate:
+                        state['tokens'] -= 1
+                    state['last'] = now
+                    return
+            time.sleep(wait)
+
+
+@timed('load')
+def loadIndex(path=None):
+    # Load the inverted index from file, JSON or binary
+    path = path or indexFile
+    if not os.path.exists(path):
         print("Index file not found. Please run the 'build' command first.")
         return None
 
+    with open(path, 'rb') as f:
+        isBinary = f.read(len(binaryMagic)) == binaryMagic
+
     print("Index Loaded.")
-    with open(indexFile, 'r') as f:
-        return json.load(f)
+    if isBinary:
+        return BinaryIndex(path)
+    return readJsonIndex(path)
+
+
+@timed('convert')
+def convertIndex(jsonPath=None, binaryPath=None):
+    # Convert a JSON index into the binary format
+    # Doc IDs follow the order pages were first seen, i.e. crawl order
+    invertedIndex = readJsonIndex(jsonPath or indexFile)
+
+    terms = ((word, ((docId, postings.positionsAt(i))
+                     for i, docId in enumerate(postings.docIds)))
+             for word, postings in sorted(invertedIndex.items(),
+                                          key=lambda item: item[0].encode('utf-8')))
+    writeBinaryIndex(binaryPath or binaryIndexFile, invertedIndex.docUrls,
+                     invertedIndex.docLengths, terms)
+
+
+# Binary index layout (little endian):
+#   header       magic, version, doc count, term count, total words in all
+#                docs, offsets of doc table, doc lengths and term table
+#   postings     per term: varint doc count, then per doc the varint doc ID
+#                delta, varint position count and varint position deltas
+#   doc URLs     UTF-8 URLs back to back
+#   doc table    doc count + 1 u64 offsets of each URL
+#   doc lengths  doc count u32 word counts
+#   term strings UTF-8 terms back to back, sorted bytewise
+#   term table   term count + 1 (u64 term offset, u64 postings offset) pairs
+binaryMagic = b'WCIX'
+binaryVersion = 2
+binaryHeader = struct.Struct('<4sIIIQQQQ')
+binaryOffset = struct.Struct('<Q')
+binaryLength = struct.Struct('<I')
+binaryTermEntry = struct.Struct('<QQ')
+
+
+@timed('serialise')
+def writeBinaryIndex(path, docUrls, docLengths, terms):
+    # Write a binary index; terms yields (word, [(docId, positions)]) with
+    # words in bytewise order and doc IDs ascending
+    termStrings = []
+    postingOffsets = []
+
+    with open(path, 'wb') as f:
+        f.write(b'\0' * binaryHeader.size)
+
+        for word, postings in terms:
+            termStrings.append(word.encode('utf-8'))
+            postingOffsets.append(f.tell())
+            writePostings(f, postings)
+        postingOffsets.append(f.tell())
+
+        docOffsets = []
+        for url in docUrls:
+            docOffsets.append(f.tell())
+            f.write(url.encode('utf-8'))
+        docOffsets.append(f.tell())
+
+        docTablePos = f.tell()
+        for offset in docOffsets:
+            f.write(binaryOffset.pack(offset))
+
+        docLengthsPos = f.tell()
+        for length in docLengths:
+            f.write(binaryLength.pack(length))
+
+        termOffsets = []
+        for term in termStrings:
+            termOffsets.append(f.tell())
+            f.write(term)
+        termOffsets.append(f.tell())
+
+        termTablePos = f.tell()
+        for termOffset, postingOffset in zip(termOffsets, postingOffsets):
+            f.write(binaryTermEntry.pack(termOffset, postingOffset))
+
+        f.seek(0)
+        f.write(binaryHeader.pack(binaryMagic, binaryVersion, len(docUrls),
+                                  len(termStrings), sum(docLengths),
+                                  docTablePos, docLengthsPos, termTablePos))
+
+
+def writePostings(f, postings):
+    # Delta + varint encode one term's postings to f. A list whose encoding
+    # outgrows postingsChunkSize is streamed out behind a placeholder doc
+    # count that is backpatched at the end, so a term in every page of a
+    # large crawl is never held in memory whole.
+    out = bytearray()
+    countPos = None
+    count = 0
+    prevDoc = 0
+    for docId, positions in postings:
+        writeVarint(out, docId - prevDoc)
+        writeVarint(out, len(positions))
+        prevPos = 0
+        for pos in positions:
+            writeVarint(out, pos - prevPos)
+            prevPos = pos
+        prevDoc = docId
+        count += 1
+        if len(out) >= postingsChunkSize:
+            if countPos is None:
+                countPos = f.tell()
+                f.write(bytes(paddedVarintSize))
+            f.write(out)
+            out.clear()
+
+    if countPos is None:
+        head = bytearray()
+        writeVarint(head, count)
+        f.write(head + out)
+        return
+    f.write(out)
+    end = f.tell()
+    f.seek(countPos)
+    f.write(paddedVarint(count))
+    f.seek(end)
+
+
+# Bytes of a fixed-width doc count, enough for any 32-bit count
+paddedVarintSize = 5
+
+
+def paddedVarint(value):
+    # value as a varint padded with continuation bytes to paddedVarintSize
+    # bytes, which readVarint decodes like any other
+    out = bytearray()
+    for _ in range(paddedVarintSize - 1):
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def writeVarint(out, value):
+    # Append value to out as a little endian base-128 varint
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def readVarint(buf, pos):
+    # Decode the varint at buf[pos], returning (value, next position)
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def writeRun(path, entries):
+    # Write (term, doc ID, positions) entries, ordered by term and then doc
+    # ID, as varint records
+    with open(path, 'wb') as f:
+        out = bytearray()
+        for term, docId, positions in entries:
+            writeVarint(out, len(term))
+            out += term
+            writeVarint(out, docId)
+            writeVarint(out, len(positions))
+            prev = 0
+            for pos in positions:
+                writeVarint(out, pos - prev)
+                prev = pos
+            if len(out) >= 1 << 16:
+                f.write(out)
+                out.clear()
+        f.write(out)
+
+
+def readRun(path):
+    # Yield the (term, doc ID, positions) entries of a run file in order
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with data:
+        pos = 0
+        while pos < len(data):
+            length, pos = readVarint(data, pos)
+            term = data[pos:pos + length]
+            docId, pos = readVarint(data, pos + length)
+            count, pos = readVarint(data, pos)
+            positions = array('I')
+            prev = 0
+            for _ in range(count):
+                delta, pos = readVarint(data, pos)
+                prev += delta
+                positions.append(prev)
+            yield term, docId, positions
+
+
+class BinaryIndex:
+    # Read-only view of a binary index file. The file is memory mapped and
+    # only the postings of the terms that are looked up get decoded, so
+    # opening it costs the same whatever the corpus size. Supports the
+    # dict-style reads used by printIndex, findWords and phraseMatch.
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.numDocs, self.numTerms, self.totalLength,
+         self.docTablePos, self.docLengthsPos, self.termTablePos) = binaryHeader.unpack_from(self.data, 0)
+        if magic != binaryMagic or version != binaryVersion:
+            raise ValueError(f"{path} is not a version {binaryVersion} binary index")
+        self.decodedTerms = functools.lru_cache(maxsize=256)(self.decodeTerm)
+        self.urlDocIds = None
+
+    def termEntry(self, i):
+        return binaryTermEntry.unpack_from(self.data, self.termTablePos + i * binaryTermEntry.size)
+
+    def termAt(self, i):
+        start = self.termEntry(i)[0]
+        end = self.termEntry(i + 1)[0]
+        return self.data[start:end]
+
+    def findTerm(self, word):
+        # Binary search the sorted term table, returning the term number or -1
+        key = word.encode('utf-8')
+        lo, hi = 0, self.numTerms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.termAt(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.numTerms and self.termAt(lo) == key:
+            return lo
+        return -1
+
+    def docUrl(self, docId):
+        start, end = struct.unpack_from('<QQ', self.data, self.docTablePos + docId * binaryOffset.size)
+        return self.data[start:end].decode('utf-8')
+
+    def docLength(self, docId):
+        return binaryLength.unpack_from(self.data, self.docLengthsPos + docId * binaryLength.size)[0]
+
+    def docIdOf(self, url):
+        # The URL -> doc ID map is only built if something asks for it
+        if self.urlDocIds is None:
+            self.urlDocIds = {self.docUrl(docId): docId for docId in range(self.numDocs)}
+        return self.urlDocIds.get(url)
+
+    def decodeTerm(self, word):
+        # TermPostings for word, or None if it is not in the index
+        i = self.findTerm(word)
+        if i < 0:
+            return None
+        pos = self.termEntry(i)[1]
+        data = self.data
+        numPostings, pos = readVarint(data, pos)
+        postings = TermPostings(self)
+        docId = 0
+        for _ in range(numPostings):
+            delta, pos = readVarint(data, pos)
+            docId += delta
+            count, pos = readVarint(data, pos)
+            positions = array('I')
+            prev = 0
+            for _ in range(count):
+                delta, pos = readVarint(data, pos)
+                prev += delta
+                positions.append(prev)
+            postings.append(docId, positions)
+        return postings
+
+    def docFrequencies(self):
+        # Read from the head of each posting list without decoding it
+        for i in range(self.numTerms):
+            yield readVarint(self.data, self.termEntry(i)[1])[0]
+
+    def get(self, word, default=None):
+        pages = self.decodedTerms(word)
+        return default if pages is None else pages
+
+    def __getitem__(self, word):
+        pages = self.decodedTerms(word)
+        if pages is None:
+            raise KeyError(word)
+        return pages
+
+    def __contains__(self, word):
+        return self.findTerm(word) >= 0
+
+    def __len__(self):
+        return self.numTerms
+
+    def __iter__(self):
+        for i in range(self.numTerms):
+            yield self.termAt(i).decode('utf-8')
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for word in self:
+            yield word, self[word]
+
+    def close(self):
+        self.decodedTerms.cache_clear()
+        self.data.close()
 
 
 def printIndex(word, invertedIndex):
@@ -73,13 +1299,56 @@ def printIndex(word, invertedIndex):
     if word in invertedIndex:
         print(f"Inverted index for '{word}':")
         for page, poss in invertedIndex[word].items():
-            print(f"\t{page}: {poss}")
+            print(f"\t{page}: {list(poss)}")
     else:
         print(f"No entry found for '{word}'.")
 
 
-def findWords(query, invertedIndex):
-    words = query.lower().split()
+def findWords(query, invertedIndex, cache=None):
+    results = findMatches(query, invertedIndex, cache)
+    if results is None:
+        print("No pages found containing any of the query words.")
+        return
+    exactPages = results['exact']
+    subphrasePages = results['subphrase']
+    generalPages = results['other']
+
+    # Display results by category
+    sumpages = sum([len(exactPages), len(subphrasePages), len(generalPages)])
+    print(f"Results ({sumpages}):")
+
+    if exactPages:
+        print("Exact Phrase Matches")
+    for match in exactPages:
+        print(f'\t{match["page"]} - Full phrase match (Total occurrences={match["totalFreq"]})')
+
+    if subphrasePages: print("Subphrase Matches")
+    for match in subphrasePages:
+        print(f'\t{match["page"]} - "{match["phrase"]}" (matchCount={match["matchCount"]}, Total occurrences={match["totalFreq"]})')
+
+    if generalPages and (exactPages or subphrasePages): print("Other Matches")
+    for match in generalPages:
+        matched_words = ', '.join(match['matchedWords'])
+        print(f'\t{match["page"]} - Matched Words: [{matched_words}] (Total occurrences={match["totalFreq"]})')
+
+
+@timed('find')
+def findMatches(query, invertedIndex, cache=None):
+    # The pages findWords() lists, as {'exact', 'subphrase', 'other'} lists
+    # of dicts in display order, or None if no page has any query word.
+    # Ties keep crawl order so the same index always gives the same output.
+    # Subphrases are shown as typed in the query. With a QueryCache,
+    # repeated queries are answered from it, whatever their casing.
+    invertedIndex = asInvertedIndex(invertedIndex)
+    queryWords = query.split()
+    words = [word.lower() for word in queryWords]
+    query = ' '.join(words)
+    if cache is not None:
+        cache.bind(invertedIndex)
+        results = cache.lookup(('find', query))
+        if results is not None:
+            return withQueryCasing(results, queryWords)
+
     pageScores = {}
 
     # Tally occurrences of each query word by page, and track matched words
@@ -95,10 +1364,8 @@ def findWords(query, invertedIndex):
                 stats['totalFreq'] += len(positions)
                 stats['matchedWords'].add(word)
 
-
     if not pageScores:
-        print("No pages found containing any of the query words.")
-        return
+        return None
 
     # Identify candidate pages with all words
     candidatePhraseMatchPages = [
@@ -106,50 +1373,196 @@ def findWords(query, invertedIndex):
     weakCandidatePhraseMatchPages = [page for page, stats in pageScores.items(
     ) if stats['matchCount'] > 1 and stats['matchCount'] < len(words)]
 
-    subPhrases = computeSubPhrases(query)
-
-    # Get exact and subphrase matches
-    exactPages = set(phraseMatch(
-        query, invertedIndex, candidatePhraseMatchPages))
+    # Get exact and subphrase matches. Every subphrase is matched by
+    # extending the one a word shorter, so the query is matched only once.
+    matcher = PhraseMatcher(invertedIndex, words, cache)
+    exactPages = set(matcher.pages(0, len(words), set(candidatePhraseMatchPages)))
 
+    weakCandidates = set(weakCandidatePhraseMatchPages)
     subphrasePages = {}
-    for subphrase in subPhrases:
-        matches = phraseMatch(subphrase, invertedIndex,
-                              weakCandidatePhraseMatchPages)
-        for p in matches:
-            if p not in exactPages:
-                subphrasePages.setdefault(p, set()).add(subphrase)
+    for length in range(2, len(words)):
+        for start in range(len(words) - length + 1):
+            subphrase = ' '.join(words[start:start + length])
+            for p in matcher.pages(start, length, weakCandidates):
+                if p not in exactPages:
+                    subphrasePages.setdefault(p, {})[subphrase] = None
 
     # Get remaining pages with only general word matches
     generalPages = {p: stats for p, stats in pageScores.items()
                     if p not in exactPages and p not in subphrasePages
                     }
 
-    # Display results by category
-    sumpages = sum([len(exactPages), len(subphrasePages), len(generalPages)])
-    print(f"Results ({sumpages}):")
-
-    if exactPages:
-        print("Exact Phrase Matches")
-    for p in sorted(exactPages, key=lambda p: (pageScores[p]['matchCount'], pageScores[p]['totalFreq']), reverse=True):
-        stats = pageScores[p]
-        print(f'\t{p} - Full phrase match (Total occurrences={stats["totalFreq"]})')
-
-    if subphrasePages: print("Subphrase Matches")
     def sort_key(p):
         longest_phrase = max(subphrasePages[p], key=len)
         return (len(longest_phrase), pageScores[p]['matchCount'], pageScores[p]['totalFreq'])
 
-    for p in sorted(subphrasePages.keys(), key=sort_key, reverse=True):
-        stats = pageScores[p]
-        longest_phrase = max(subphrasePages[p], key=len)
-        print(f'\t{p} - "{longest_phrase}" (matchCount={stats["matchCount"]}, Total occurrences={stats["totalFreq"]})')
+    results = {
+        'exact': [
+            {'page': p, 'matchCount': pageScores[p]['matchCount'], 'totalFreq': pageScores[p]['totalFreq']}
+            for p in sorted([p for p in pageScores if p in exactPages], key=lambda p: (pageScores[p]['matchCount'], pageScores[p]['totalFreq']), reverse=True)],
+        'subphrase': [
+            {'page': p, 'phrase': max(subphrasePages[p], key=len),
+             'matchCount': pageScores[p]['matchCount'], 'totalFreq': pageScores[p]['totalFreq']}
+            for p in sorted([p for p in pageScores if p in subphrasePages], key=sort_key, reverse=True)],
+        'other': [
+            {'page': p, 'matchedWords': sorted(stats['matchedWords']),
+             'matchCount': stats['matchCount'], 'totalFreq': stats['totalFreq']}
+            for p, stats in sorted(generalPages.items(), key=lambda item: (item[1]['matchCount'], item[1]['totalFreq']), reverse=True)],
+    }
+    if cache is not None:
+        cache.put(('find', query), results)
+    return withQueryCasing(results, queryWords)
 
 
-    if generalPages and (exactPages or subphrasePages): print("Other Matches")
-    for p, stats in sorted(generalPages.items(), key=lambda item: (item[1]['matchCount'], item[1]['totalFreq']), reverse=True):
-        matched_words = ', '.join(sorted(stats['matchedWords']))
-        print(f'\t{p} - Matched Words: [{matched_words}] (Total occurrences={stats["totalFreq"]})')
+def withQueryCasing(results, queryWords):
+    # Copy of findMatches() results with subphrases as typed in the query
+    typed = {}
+    for length in range(2, len(queryWords)):
+        for start in range(len(queryWords) - length + 1):
+            phrase = queryWords[start:start + length]
+            typed.setdefault(' '.join(phrase).lower(), ' '.join(phrase))
+    return dict(results, subphrase=[dict(match, phrase=typed.get(match['phrase'], match['phrase']))
+                                    for match in results['subphrase']])
+
+
+class QueryCache:
+    # LRU cache of query results and matched phrase postings. It belongs to
+    # one index at a time and empties itself when used with another index,
+    # or after the one it has was updated.
+    def __init__(self, maxSize=None):
+        self.maxSize = maxSize or queryCacheSize
+        self.entries = OrderedDict()
+        self.invertedIndex = None
+        self.version = None
+        self.hits = 0  # lookup() calls, i.e. whole queries, answered from the cache
+        self.misses = 0
+
+    def bind(self, invertedIndex):
+        version = getattr(invertedIndex, 'version', 0)
+        if invertedIndex is not self.invertedIndex or version != self.version:
+            self.clear()
+            self.invertedIndex = invertedIndex
+            self.version = version
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def lookup(self, key):
+        # get() for a whole query, counted in the hit rate. Phrase postings
+        # are cached with plain get(), so they do not skew it.
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+            crawlStats.count('cacheMisses')
+        else:
+            self.hits += 1
+            crawlStats.count('cacheHits')
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def runBatch(invertedIndex, inputPath, outputPath=None, mode="find", k=None,
+             workers=0, indexPath=None, cache=None, field=None):
+    # Answer every query in inputPath ('-' for stdin), one per line as plain
+    # text or as a JSON object with the query in field (batchQueryField by
+    # default), writing one JSON line per query to outputPath (stdout if not
+    # given). With workers > 0 the queries are shared out to processes that
+    # each open indexPath.
+    queries = readBatchQueries(inputPath, field or batchQueryField)
+    if not queries:
+        print(f"No queries found in {inputPath}.", file=sys.stderr)
+        return 0
+    out = open(outputPath, 'w') if outputPath else sys.stdout
+    try:
+        if workers:
+            with ProcessPoolExecutor(max_workers=workers, initializer=startBatchWorker,
+                                     initargs=(indexPath or indexFile,)) as pool:
+                answers = pool.map(answerBatchQuery, queries, itertools.repeat(mode),
+                                   itertools.repeat(k), chunksize=16)
+                for answer, workerStats in answers:
+                    crawlStats.merge(workerStats)
+                    out.write(json.dumps(answer) + '\n')
+        else:
+            cache = cache if cache is not None else QueryCache()
+            for query in queries:
+                answer = answerQuery(query, invertedIndex, mode, k, cache)
+                out.write(json.dumps(answer) + '\n')
+    finally:
+        if outputPath:
+            out.close()
+    return len(queries)
+
+
+def readBatchQueries(inputPath, field):
+    # Queries from a batch file. Malformed JSON lines, and JSON lines
+    # without a string query in field, are reported on stderr and skipped.
+    f = sys.stdin if inputPath == '-' else open(inputPath, 'r')
+    try:
+        queries = []
+        for lineNumber, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    print(f"Skipping line {lineNumber}: {e}", file=sys.stderr)
+                    continue
+                if not isinstance(record, dict) or field not in record:
+                    print(f"Skipping line {lineNumber}: no '{field}' field", file=sys.stderr)
+                    continue
+                line = record[field]
+                if not isinstance(line, str):
+                    print(f"Skipping line {lineNumber}: '{field}' is not a string", file=sys.stderr)
+                    continue
+            if line.strip():
+                queries.append(line)
+        return queries
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def answerQuery(query, invertedIndex, mode="find", k=None, cache=None):
+    # One batch result: the query and its matches as JSON-ready data. A
+    # query matching nothing has empty results, never null.
+    if mode == "search":
+        results = [{'page': page, 'score': score, 'phrase': phrase}
+                   for page, score, phrase in searchIndex(query, invertedIndex, k, cache)]
+    else:
+        results = findMatches(query, invertedIndex, cache) or {'exact': [], 'subphrase': [], 'other': []}
+    return {'query': query, 'mode': mode, 'results': results}
+
+
+# Index and cache of a batch worker process
+batchWorker = {}
+
+
+def startBatchWorker(indexPath):
+    with contextlib.redirect_stdout(io.StringIO()):
+        batchWorker['index'] = loadIndex(indexPath)
+    if batchWorker['index'] is None:
+        raise FileNotFoundError(f"Index file {indexPath} not found")
+    batchWorker['cache'] = QueryCache()
+
+
+def answerBatchQuery(query, mode, k):
+    # The answer, and the worker's stats since its last answer for the
+    # parent to merge
+    answer = answerQuery(query, batchWorker['index'], mode, k, batchWorker['cache'])
+    return answer, crawlStats.drain()
 
 
 def computeSubPhrases(query):
@@ -177,23 +1590,271 @@ def checkSubPhrases(subphrase, invertedIndex, pages):
 
 def phraseMatch(phrase, invertedIndex, candidatePages):
     # Check whether subphrases appear in sequence in any candidate page
-    words = phrase.lower().split()
-    exactPages = []
+    invertedIndex = asInvertedIndex(invertedIndex)
+    hits = matchPhrase(invertedIndex, phrase.lower().split())
+    matchedDocs = set(hits.docIds)
+    return [page for page in candidatePages
+            if invertedIndex.docIdOf(page) in matchedDocs]
+
+
+def asInvertedIndex(invertedIndex):
+    # Accept a plain {word: {url: positions}} dict as well as index objects
+    if isinstance(invertedIndex, dict):
+        return InvertedIndex.fromDict(invertedIndex)
+    return invertedIndex
+
+
+def matchPhrase(invertedIndex, words):
+    # Occurrences of the phrase as a TermPostings of start positions.
+    # Starts from the term in the fewest docs and intersects the others
+    # into it in order of rarity, skipping docs missing any term.
+    postingsList = [invertedIndex.get(word) for word in words]
+    if not words or any(postings is None for postings in postingsList):
+        return TermPostings(invertedIndex)
+
+    order = sorted(range(len(words)), key=lambda k: len(postingsList[k]))
+    rarest = postingsList[order[0]]
+    hits = TermPostings(invertedIndex)
+    for i, docId in enumerate(rarest.docIds):
+        starts = array('I', (pos - order[0] for pos in rarest.positionsAt(i)
+                             if pos >= order[0]))
+        if starts:
+            hits.append(docId, starts)
+
+    for k in order[1:]:
+        hits = extendPhrase(hits, postingsList[k], k)
+    return hits
+
+
+def extendPhrase(hits, postings, shift):
+    # Keep the hits whose start + shift is a position of postings. Both
+    # intersections walk the shorter list and binary search the longer one
+    # forward from the previous match, skipping the runs in between.
+    extended = TermPostings(hits.docs)
+    for i, j in intersectSorted(hits.docIds, postings.docIds):
+        starts = shiftedIntersect(hits.positionsAt(i), postings.positionsAt(j), shift)
+        if starts:
+            extended.append(hits.docIds[i], starts)
+    return extended
+
+
+def intersectSorted(left, right):
+    # (i, j) index pairs of the values common to two ascending lists
+    pairs = []
+    swapped = len(left) > len(right)
+    if swapped:
+        left, right = right, left
+    j = 0
+    for i, value in enumerate(left):
+        j = bisect_left(right, value, j)
+        if j == len(right):
+            break
+        if right[j] == value:
+            pairs.append((j, i) if swapped else (i, j))
+    return pairs
+
+
+def shiftedIntersect(starts, positions, shift):
+    # Starts s for which s + shift is in positions; both lists are sorted
+    matched = array('I')
+    if len(starts) <= len(positions):
+        j = 0
+        for start in starts:
+            j = bisect_left(positions, start + shift, j)
+            if j == len(positions):
+                break
+            if positions[j] == start + shift:
+                matched.append(start)
+    else:
+        i = 0
+        for pos in positions:
+            if pos < shift:
+                continue
+            i = bisect_left(starts, pos - shift, i)
+            if i == len(starts):
+                break
+            if starts[i] == pos - shift:
+                matched.append(pos - shift)
+    return matched
+
+
+class PhraseMatcher:
+    # Phrase matches for the subphrases of one query. The match for
+    # words[start:start + length] is built from the memoised match one word
+    # shorter, so overlapping subphrases share their intersections. With a
+    # QueryCache, phrases matched by earlier queries are reused as well.
+    def __init__(self, invertedIndex, words, cache=None):
+        self.invertedIndex = invertedIndex
+        self.words = words
+        self.memo = {}
+        self.cache = cache
+
+    def match(self, start, length):
+        # TermPostings of the start positions of words[start:start + length]
+        key = (start, length)
+        if key not in self.memo:
+            if length == 1:
+                hits = self.invertedIndex.get(self.words[start])
+                if hits is None:
+                    hits = TermPostings(self.invertedIndex)
+            else:
+                phraseKey = ('phrase', tuple(self.words[start:start + length]))
+                hits = self.cache.get(phraseKey) if self.cache is not None else None
+                if hits is None:
+                    shorter = self.match(start, length - 1)
+                    postings = self.invertedIndex.get(self.words[start + length - 1])
+                    if postings is None:
+                        hits = TermPostings(self.invertedIndex)
+                    else:
+                        hits = extendPhrase(shorter, postings, length - 1)
+                    if self.cache is not None:
+                        self.cache.put(phraseKey, hits)
+            self.memo[key] = hits
+        return self.memo[key]
+
+    def pages(self, start, length, candidatePages):
+        # URLs of the candidate pages containing the subphrase
+        return [page for page in map(self.invertedIndex.docUrl, self.match(start, length).docIds)
+                if page in candidatePages]
+
+
+@timed('search')
+def searchIndex(query, invertedIndex, k=None, cache=None):
+    # Top k pages for the query as (url, score, phrase) tuples, best first.
+    # Pages are scored with BM25. As in findWords(), pages containing the
+    # whole query come first, then pages by their longest matched subphrase:
+    # a phrase of n words adds n times the highest BM25 score the query can
+    # reach. phrase is the longest phrase matched, or None.
+    invertedIndex = asInvertedIndex(invertedIndex)
+    k = k or topK
+    if cache is not None:
+        cache.bind(invertedIndex)
+        cacheKey = ('search', ' '.join(query.lower().split()), k)
+        ranked = cache.lookup(cacheKey)
+        if ranked is not None:
+            return ranked
+    words = query.lower().split()
+
+    # BM25 weight of each distinct query word, and the most it can add
+    numDocs = invertedIndex.numDocs
+    averageLength = invertedIndex.totalLength / max(numDocs, 1)
+    wordCounts = {}
+    for word in words:
+        wordCounts[word] = wordCounts.get(word, 0) + 1
+    terms = []
+    for word, count in wordCounts.items():
+        postings = invertedIndex.get(word)
+        if postings is None:
+            continue
+        docFreq = len(postings)
+        weight = count * math.log(1 + (numDocs - docFreq + 0.5) / (docFreq + 0.5))
+        terms.append((weight * (bm25K1 + 1), weight, postings))
+    if not terms:
+        if cache is not None:
+            cache.put(cacheKey, [])
+        return []
+    maxScore = sum(term[0] for term in terms)
 
-    for page in candidatePages:
-        # Collect positionss for each word
-        word_positions = []
-        for word in words:
-            positions = invertedIndex.get(word, {}).get(page, [])
-            word_positions.append(set(positions))
+    def lengthNorm(docId):
+        return bm25K1 * (1 - bm25B + bm25B * invertedIndex.docLength(docId) / averageLength)
 
-        # Check for sequence of positions
-        possible_starts = word_positions[0]
-        for start_pos in possible_starts:
-            if all((start_pos + offset) in word_positions[offset] for offset in range(1, len(words))):
-                exactPages.append(page)
-                break  # No need to check other positions
-    return exactPages
+    def termScore(weight, freq, norm):
+        return weight * freq * (bm25K1 + 1) / (freq + norm)
+
+    # Longest phrase of 2+ words in each page
+    phrases = {}
+    matcher = PhraseMatcher(invertedIndex, words, cache)
+    for length in range(len(words), 1, -1):
+        for start in range(len(words) - length + 1):
+            for docId in matcher.match(start, length).docIds:
+                if docId not in phrases:
+                    phrases[docId] = (length, ' '.join(words[start:start + length]))
+
+    # Min-heap of the best k (score, -docId); ties go to the earlier page
+    results = []
+
+    def offer(score, docId):
+        if len(results) < k:
+            heapq.heappush(results, (score, -docId))
+        elif (score, -docId) > results[0]:
+            heapq.heapreplace(results, (score, -docId))
+
+    for docId, (length, phrase) in phrases.items():
+        norm = lengthNorm(docId)
+        score = length * maxScore
+        for ub, weight, postings in terms:
+            i = postings.findDoc(docId)
+            if i >= 0:
+                score += termScore(weight, postings.frequencyAt(i), norm)
+        offer(score, docId)
+
+    # MaxScore over the remaining pages. Terms are ordered by the most they
+    # can add; once the top k threshold is above what the lowest terms can
+    # reach together, pages containing only those terms cannot make the
+    # cut, so only the postings of the other ("essential") terms are walked
+    # and the low terms are looked up while the page can still qualify.
+    terms.sort(key=lambda term: term[0])
+    bounds = list(itertools.accumulate(term[0] for term in terms))
+    cursors = [0] * len(terms)
+    firstEssential = 0
+    while True:
+        threshold = results[0][0] if len(results) == k else 0
+        while firstEssential < len(terms) and bounds[firstEssential] <= threshold:
+            firstEssential += 1
+
+        docId = None
+        for t in range(firstEssential, len(terms)):
+            docIds = terms[t][2].docIds
+            if cursors[t] < len(docIds) and (docId is None or docIds[cursors[t]] < docId):
+                docId = docIds[cursors[t]]
+        if docId is None:
+            break
+
+        norm = lengthNorm(docId)
+        score = 0
+        for t in range(firstEssential, len(terms)):
+            ub, weight, postings = terms[t]
+            i = cursors[t]
+            if i < len(postings.docIds) and postings.docIds[i] == docId:
+                score += termScore(weight, postings.frequencyAt(i), norm)
+                cursors[t] = i + 1
+        if docId in phrases:
+            continue
+
+        for t in range(firstEssential - 1, -1, -1):
+            if score + bounds[t] <= threshold:
+                break
+            ub, weight, postings = terms[t]
+            i = postings.findDoc(docId)
+            if i >= 0:
+                score += termScore(weight, postings.frequencyAt(i), norm)
+        if score > threshold:
+            offer(score, docId)
+
+    ranked = []
+    for score, negDocId in sorted(results, reverse=True):
+        phrase = phrases.get(-negDocId, (0, None))[1]
+        ranked.append((invertedIndex.docUrl(-negDocId), score, phrase))
+    if cache is not None:
+        cache.put(cacheKey, ranked)
+    return ranked
+
+
+def printSearch(query, invertedIndex, k=None, cache=None):
+    # Print the top k pages for a query with their scores
+    results = searchIndex(query, invertedIndex, k, cache)
+    if not results:
+        print("No pages found containing any of the query words.")
+        return
+
+    print(f"Top {len(results)} results:")
+    for page, score, phrase in results:
+        if phrase is None:
+            print(f'\t{page} (score={score:.2f})')
+        elif len(phrase.split()) == len(query.split()):
+            print(f'\t{page} - Full phrase match (score={score:.2f})')
+        else:
+            print(f'\t{page} - "{phrase}" (score={score:.2f})')
 
 
 def removePunctuation(text):
@@ -205,19 +1866,48 @@ def removePunctuation(text):
     return text.strip().split()
 
 
-def fetchPage(url):
-    # Get Page
-    response = requests.get(url)
-    return response.text
+def fetchPage(url, session=None, record=None):
+    # Get Page, reusing the session's pooled connections when given one.
+    # With the page's record from an earlier crawl the request is
+    # conditional, and an unchanged page comes back as an empty 304. A
+    # stalled server raises requests.Timeout after fetchTimeout seconds
+    # rather than holding up every page queued behind it.
+    headers = {}
+    if record and record.get('etag'):
+        headers['If-None-Match'] = record['etag']
+    if record and record.get('lastModified'):
+        headers['If-Modified-Since'] = record['lastModified']
+    with crawlStats.timer('fetch'):
+        response = (session or requests).get(url, headers=headers, timeout=fetchTimeout)
+    crawlStats.count('pagesFetched')
+    crawlStats.count('bytesFetched', len(response.content))
+    if response.status_code == 304:
+        crawlStats.count('pagesNotModified')
+    return response
+
+
+def makeSession(poolSize):
+    # HTTP session keeping up to poolSize keep-alive connections per host
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 def main():
     # Command loop: build, load, print, find, or exit
+    if len(sys.argv) > 1:
+        batchMain(sys.argv[1:])
+        return
+
     currentIndex = None
+    queryCache = QueryCache()
 
     while True:
         userInput = input(
-            "Enter command (build, load, print [word], find [phrase], exit): ").strip()
+            "Enter command (build [concurrent] [streaming], update [concurrent], load [binary], convert, print [word], find [phrase], search [phrase], batch [file] [output], stats [json|reset] [file], profile [on|off] [file], exit): ").strip()
         if not userInput:
             continue
 
@@ -227,10 +1917,27 @@ def main():
         if command == "exit":
             break
         elif command == "build":
-            buildIndex()
+            options = set(parts[1:])
+            if "streaming" in options:
+                buildIndexStreaming(concurrent="concurrent" in options)
+                currentIndex = loadIndex(binaryIndexFile)
+            else:
+                buildIndex(concurrent="concurrent" in options)
+                currentIndex = loadIndex()
+        elif command == "update":
+            updateIndex(concurrent=parts[1:] == ["concurrent"])
             currentIndex = loadIndex()
         elif command == "load":
-            currentIndex = loadIndex()
+            if parts[1:] == ["binary"]:
+                currentIndex = loadIndex(binaryIndexFile)
+            else:
+                currentIndex = loadIndex()
+        elif command == "convert":
+            if not os.path.exists(indexFile):
+                print("Index file not found. Please run the 'build' command first.")
+                continue
+            convertIndex()
+            print(f"Wrote {binaryIndexFile}.")
         elif command == "print":
             if len(parts) != 2:
                 print("Usage: print [word]")
@@ -246,10 +1953,85 @@ def main():
             if currentIndex is None:
                 print("Please load or build the index first.")
                 continue
-            findWords(' '.join(parts[1:]), currentIndex)
+            findWords(' '.join(parts[1:]), currentIndex, queryCache)
+        elif command == "search":
+            if len(parts) < 2:
+                print("Usage: search [word or phrase]")
+                continue
+            if currentIndex is None:
+                print("Please load or build the index first.")
+                continue
+            printSearch(' '.join(parts[1:]), currentIndex, cache=queryCache)
+        elif command == "batch":
+            if len(parts) not in (2, 3):
+                print("Usage: batch [file] [output]")
+                continue
+            if currentIndex is None:
+                print("Please load or build the index first.")
+                continue
+            count = runBatch(currentIndex, parts[1], parts[2] if len(parts) == 3 else None,
+                             cache=queryCache)
+            print(f"Answered {count} queries.")
+        elif command == "stats":
+            if parts[1:2] == ["json"]:
+                dumpStats(currentIndex, parts[2] if len(parts) > 2 else None)
+            elif parts[1:] == ["reset"]:
+                crawlStats.reset()
+            else:
+                printStats(currentIndex)
+        elif command == "profile":
+            if parts[1:] == ["on"]:
+                if profiler is None:
+                    startProfile()
+                print("Profiling on.")
+            elif parts[1:2] == ["off"] and profiler is not None:
+                stopProfile(parts[2] if len(parts) > 2 else None)
+            else:
+                print("Usage: profile on, then profile off [file]")
         else:
             print("Unknown command.")
 
 
+def batchMain(args):
+    # python crawler.py batch QUERIES [-o OUTPUT] [--search] [-k K] [--workers N] [--index PATH] [--field NAME] [--stats FILE] [--profile FILE]
+    parser = argparse.ArgumentParser(prog='crawler.py batch',
+                                     description='Run queries from a file and write JSON lines.')
+    parser.add_argument('command', choices=['batch'])
+    parser.add_argument('queries', help="file of queries, or - for stdin")
+    parser.add_argument('-o', '--output', help="output file (default stdout)")
+    parser.add_argument('--search', action='store_true', help="ranked top-k results instead of find")
+    parser.add_argument('-k', type=int, default=None, help="results per query with --search")
+    parser.add_argument('--workers', type=int, default=0, help="worker processes")
+    parser.add_argument('--index', default=indexFile, help="index file, JSON or binary")
+    parser.add_argument('--field', default=batchQueryField, help="query field of JSON input lines")
+    parser.add_argument('--stats', help="write timing statistics as JSON to this file")
+    parser.add_argument('--profile', help="profile the run and save the cProfile data to this file")
+    options = parser.parse_args(args)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        if options.workers:
+            # Workers open their own copies, so only check it is there
+            invertedIndex = None
+            if not os.path.exists(options.index):
+                print("Index file not found. Please run the 'build' command first.")
+                sys.exit(1)
+        else:
+            invertedIndex = loadIndex(options.index)
+            if invertedIndex is None:
+                sys.exit(1)
+    if options.profile:
+        startProfile()
+    count = runBatch(invertedIndex, options.queries, options.output,
+                     "search" if options.search else "find", options.k, options.workers, options.index,
+                     field=options.field)
+    if options.profile:
+        with contextlib.redirect_stdout(sys.stderr):
+            stopProfile(options.profile)
+    if options.stats:
+        dumpStats(invertedIndex, options.stats)
+    if not count:
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     main()